@@ -16,16 +16,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
-import ast
 import asyncio
+import json
 import logging
 import re
 import sys
 from configparser import ConfigParser
-from typing import List
+from typing import FrozenSet, List, Set
 
 import aioredis
 import pyrogram
+from aiolimiter import AsyncLimiter
 from pyrogram import Client, filters
 from pyrogram.enums import ParseMode
 from pyrogram.handlers import CallbackQueryHandler, MessageHandler
@@ -41,7 +42,9 @@ except ImportError as e:
 
 logger = logging.getLogger('code_poster')
 
-PASSCODE_EXP = re.compile(r'^\w{5,35}$')
+PASSCODE_EXP = re.compile(r'\w{5,35}')
+SEND_INTERVAL = 2
+OWNER_COMMAND_FILTER = filters.command(['h', 'del'])
 
 
 class Tracker:
@@ -51,29 +54,32 @@ class Tracker:
         self.conn = conn
         self.channel_id = channel_id
         self.password = password
-        self.owners: List[int] = ast.literal_eval(owners)
+        self.owners: FrozenSet[int] = frozenset(json.loads(owners or '[]'))
         self.redis = redis
+        self.send_limiter = AsyncLimiter(1, SEND_INTERVAL)
+        # In-process mirror of the tracker_user Redis set
+        self._auth_cache: Set[int] = set()
         self.init_message_handler()
 
     def init_message_handler(self) -> None:
         self.app.add_handler(MessageHandler(self.handle_auth, filters.command('auth') & filters.private))
-        self.app.add_handler(MessageHandler(self.pre_check, filters.text & filters.private))
-        self.app.add_handler(MessageHandler(self.handle_passcode, filters.text & filters.private))
+        self.app.add_handler(MessageHandler(self.handle_text, filters.text & filters.private))
         self.app.add_handler(CallbackQueryHandler(self.handle_callback_query))
-        self.app.add_handler(MessageHandler(self.pre_check_owner, filters.text & filters.private))
-        self.app.add_handler(MessageHandler(self.query_history, filters.command('h') & filters.private))
-        self.app.add_handler(MessageHandler(self.delete_user_manual, filters.command('del') & filters.private))
 
     async def start(self) -> None:
-        await asyncio.gather(self.app.start(), self._load_users())
+        # Caches must be filled before updates queued while offline are dispatched
+        await asyncio.gather(self.conn.start(), self._load_users(), self._load_codes())
+        await self.app.start()
 
     @staticmethod
     async def idle() -> None:
         await pyrogram.idle()
 
     async def stop(self) -> None:
-        await asyncio.gather(self.app.stop(),
-                             self.redis.close())
+        # Handlers still running while the client stops may use redis and the database
+        await self.app.stop()
+        await asyncio.gather(self.redis.close(),
+                             self.conn.close())
 
     @classmethod
     async def load_from_config(cls, config: ConfigParser, *, debug: bool = False, database_file: str = 'codes.db'):
@@ -95,22 +101,38 @@ class Tracker:
         if len(msg.text) > 30:
             await msg.reply("Passcode length exceed")
             return
-        if PASSCODE_EXP.match(msg.text) is None:
+        if PASSCODE_EXP.fullmatch(msg.text) is None:
             await msg.reply("Passcode format error")
             return
-        result = await self.conn.query(msg.text)
-        if result is None:
-            _msg = await client.send_message(self.channel_id, f'<code>{msg.text}</code>', ParseMode.HTML)
-            await asyncio.gather(self.conn.insert(msg.text, _msg.id),
-                                 self.conn.insert_history(msg.text, msg.chat.id),
+        if (await self.claim_passcodes([msg.text]))[0]:
+            try:
+                _msg = await client.send_message(self.channel_id, f'<code>{msg.text}</code>', ParseMode.HTML)
+            except Exception:
+                await self.redis.srem('tracker_codes', msg.text.lower())
+                raise
+            await asyncio.gather(self.conn.insert_pair(msg.text, _msg.id, msg.chat.id),
                                  self.hook_send_passcode(msg.text))
             await msg.reply('Send successful')
+            return
+        result = await self.conn.query(msg.text)
+        if result is None:
+            await msg.reply('Passcode is being sent')
         else:
             await msg.reply(f"Passcode exist, {'mark passcode' if not result.FR else 'undo mark'} as FR?",
                             reply_markup=InlineKeyboardMarkup([[
                                 InlineKeyboardButton(
                                     "Process", f"{'u' if result.FR else 'm'} {msg.text} {result.message_id}")]]))
 
+    # Add passcodes to tracker_codes before sending them, so a concurrent message carrying the same
+    # code sees it as a duplicate. True means the code was claimed by this call.
+    async def claim_passcodes(self, passcodes: List[str]) -> List[bool]:
+        if not passcodes:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for passcode in passcodes:
+                pipe.sadd('tracker_codes', passcode.lower())
+            return [bool(added) for added in await pipe.execute()]
+
     async def hook_send_passcode(self, passcode: str) -> None:
         pass
 
@@ -123,40 +145,61 @@ class Tracker:
         return f'{header} codes:\n<code>{f"</code>{nl}<code>".join(passcodes)}</code>\n' if passcodes else ''
 
     async def handle_multiline_passcode(self, client: Client, msg: Message) -> None:
-        count = 0
         error_codes = []
         duplicate_codes = []
-        status_message = None
+        candidates = {}
+        fullmatch = PASSCODE_EXP.fullmatch
         for passcode in msg.text.splitlines(False):
             if passcode == '' or passcode.startswith('#'):
                 continue
-            if len(passcode) > 35 or PASSCODE_EXP.match(passcode) is None:
+            if len(passcode) > 35 or fullmatch(passcode) is None:
                 error_codes.append(passcode)
-                continue
-            if await self.conn.query(passcode) is None:
-                if status_message is None:
-                    status_message = await msg.reply('Sending passcode (interval: 2s)')
-                _msg = await client.send_message(self.channel_id, f'<code>{passcode}</code>', ParseMode.HTML)
-                count += 1
-                await asyncio.gather(self.conn.insert(passcode, _msg.id),
-                                     self.conn.insert_history(passcode, msg.chat.id),
-                                     asyncio.sleep(2),
-                                     self.hook_send_passcode(passcode))
-            else:
+            elif passcode.lower() in candidates:
                 duplicate_codes.append(passcode)
+            else:
+                candidates[passcode.lower()] = passcode
+        new_codes = []
+        for passcode, claimed in zip(candidates.values(), await self.claim_passcodes(list(candidates))):
+            (new_codes if claimed else duplicate_codes).append(passcode)
+        failed_codes = []
+        sent_codes = []
+        status_message = None
+        if new_codes:
+            status_message = await msg.reply(f'Sending passcode (interval: {SEND_INTERVAL}s)')
+            channel_id, send_message, send_limiter = self.channel_id, client.send_message, self.send_limiter
+            # Sent one by one so the posts keep the order of the paste
+            for passcode in new_codes:
+                try:
+                    async with send_limiter:
+                        _msg = await send_message(channel_id, f'<code>{passcode}</code>', ParseMode.HTML)
+                except Exception as e:
+                    logger.error('Send passcode %s failed: %r', passcode, e)
+                    failed_codes.append(passcode)
+                else:
+                    sent_codes.append((passcode, _msg.id))
+        if failed_codes:
+            await self.redis.srem('tracker_codes', *(code.lower() for code in failed_codes))
+        if sent_codes:
+            try:
+                await asyncio.gather(self.conn.insert_many(sent_codes, msg.chat.id),
+                                     *(self.hook_send_passcode(code) for code, _ in sent_codes))
+            except Exception:
+                logger.exception('Store sent passcodes failed')
         error_msg = self.parse_codes(error_codes, 'Error')
         duplicate_msg = self.parse_codes(duplicate_codes, 'Duplicate')
+        failed_msg = self.parse_codes(failed_codes, 'Failed')
         if status_message is None:
             edit_func = msg.reply
         else:
             edit_func = status_message.edit
-        await edit_func(f'{error_msg}\n{duplicate_msg}\nSuccess send: {count} passcode(s)')
+        await edit_func(f'{error_msg}\n{duplicate_msg}\n{failed_msg}Success send: {len(sent_codes)} passcode(s)')
 
     async def handle_callback_query(self, client: Client, msg: CallbackQuery) -> None:
         args = msg.data.split()
         if len(args) != 3:
             if args[0] == 'ignore':
-                await asyncio.gather(msg.edit_message_reply_markup(), msg.answer())
+                await msg.edit_message_reply_markup()
+                await msg.answer()
             return
 
         # Account process
@@ -176,7 +219,8 @@ class Tracker:
                 ), msg.answer(answer_msg), client.send_message(user_id, 'Access granted'))
             elif sub_arg == 'deny':
                 if await self.query_authorized_user(user_id):
-                    await asyncio.gather(msg.message.edit_reply_markup(), msg.answer('Out of dated'))
+                    await msg.message.edit_reply_markup()
+                    await msg.answer('Out of dated')
                     return
                 await asyncio.gather(msg.message.edit_reply_markup(),
                                      client.send_message(user_id, 'Access denied'), msg.answer())
@@ -204,63 +248,78 @@ class Tracker:
             return
         if len(msg.command) == 1:
             logger.debug('User %d request to grant talk power', msg.chat.id)
-            await asyncio.gather(*[client.send_message(
-                owner,
-                f"User [{msg.chat.id}](tg://user?id={msg.chat.id}) request to grant talk power",
-                ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [InlineKeyboardButton('Agree', f'account grant {msg.chat.id}'),
-                         InlineKeyboardButton('Deny', f'account deny {msg.chat.id}')],
-                        [InlineKeyboardButton('Ignore', 'ignore')]
-                    ])) for owner in self.owners])
+            text = f"User [{msg.chat.id}](tg://user?id={msg.chat.id}) request to grant talk power"
+            markup = InlineKeyboardMarkup(
+                [
+                    [InlineKeyboardButton('Agree', f'account grant {msg.chat.id}'),
+                     InlineKeyboardButton('Deny', f'account deny {msg.chat.id}')],
+                    [InlineKeyboardButton('Ignore', 'ignore')]
+                ])
+            owners = list(self.owners)
+            results = await asyncio.gather(*[client.send_message(owner, text, ParseMode.MARKDOWN, reply_markup=markup)
+                                             for owner in owners], return_exceptions=True)
+            for owner, result in zip(owners, results):
+                if isinstance(result, BaseException):
+                    logger.error('Notify owner %d failed: %r', owner, result)
         elif len(msg.command) == 2 and msg.command[1] == self.password:
             await self.insert_authorized_user(msg.chat.id)
             if len(self.owners):
                 await msg.reply('Authorized')
             else:
-                self.owners.append(msg.chat.id)
+                self.owners = self.owners | {msg.chat.id}
                 await msg.reply('Authorized as owner')
 
-    async def pre_check(self, _client: Client, msg: Message) -> None:
-        if await self.query_authorized_user(msg.chat.id):
-            msg.continue_propagation()
+    async def handle_text(self, client: Client, msg: Message) -> None:
+        if not await self.query_authorized_user(msg.chat.id):
+            return
+        if msg.chat.id in self.owners and await OWNER_COMMAND_FILTER(client, msg):
+            if msg.command[0] == 'h':
+                return await self.query_history(client, msg)
+            return await self.delete_user_manual(client, msg)
+        await self.handle_passcode(client, msg)
 
     async def query_authorized_user(self, user_id: int) -> bool:
-        return await self.redis.sismember('tracker_user', str(user_id))
+        return user_id in self._auth_cache
 
     async def insert_authorized_user(self, user_id: int) -> None:
         logger.info('Insert user %d to database', user_id)
+        self._auth_cache.add(user_id)
         await asyncio.gather(self.conn.insert_user(user_id),
                              self.redis.sadd("tracker_user", str(user_id)))
 
     async def delete_authorized_user(self, user_id: int) -> None:
         logger.info('Delete user %d from database', user_id)
+        self._auth_cache.discard(user_id)
         await asyncio.gather(self.conn.delete_user(user_id),
                              self.redis.srem("tracker_user", str(user_id)))
 
     async def flood_check(self, user_id: int, timeout: int = 120) -> bool:
-        if await self.redis.get(f'flood_{user_id}') is None:
-            await self.redis.set(f'flood_{user_id}', '1', ex=timeout)
-            return False
-        return True
+        return not await self.redis.set(f'flood_{user_id}', '1', ex=timeout, nx=True)
 
     async def _load_users(self) -> None:
-        await self.redis.delete('tracker_user')
-        async for x in self.conn.query_all_user():
-            await self.redis.sadd('tracker_user', str(x))
+        users = await self.conn.query_all_user()
         if not self.owners:
             logger.warning('Not owners ')
-        for x in self.owners:
-            await self.redis.sadd('tracker_user', str(x))
+        users.extend(self.owners)
+        self._auth_cache = set(users)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete('tracker_user')
+            if users:
+                pipe.sadd('tracker_user', *map(str, users))
+            await pipe.execute()
         logger.info('Load users successful')
 
-    async def pre_check_owner(self, _client: Client, msg: Message) -> None:
-        if msg.chat.id in self.owners:
-            msg.continue_propagation()
+    async def _load_codes(self) -> None:
+        codes = await self.conn.query_all_code()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete('tracker_codes')
+            if codes:
+                pipe.sadd('tracker_codes', *codes)
+            await pipe.execute()
+        logger.info('Load %d passcode(s) successful', len(codes))
 
     async def query_history(self, _client: Client, msg: Message) -> None:
-        if len(msg.command) > 2:
+        if len(msg.command) != 2:
             await msg.reply('Query format error.')
             return
         _, code = msg.command
@@ -272,13 +331,15 @@ class Tracker:
 
     async def delete_user_manual(self, client: Client, msg: Message) -> None:
         if len(msg.command) != 2:
-            user_id = int(msg.command[1])
-            if await self.query_authorized_user(user_id):
-                await asyncio.gather(client.send_message(user_id, "Access revoked"),
-                                     self.delete_authorized_user(user_id),
-                                     msg.reply('Success'))
-            else:
-                await msg.reply('User not in authorized list')
+            await msg.reply('Usage: /del <user_id>')
+            return
+        user_id = int(msg.command[1])
+        if await self.query_authorized_user(user_id):
+            await asyncio.gather(client.send_message(user_id, "Access revoked"),
+                                 self.delete_authorized_user(user_id),
+                                 msg.reply('Success'))
+        else:
+            await msg.reply('User not in authorized list')
 
 
 async def main(debug: bool = False):
@@ -298,4 +359,9 @@ if __name__ == '__main__':
     except ModuleNotFoundError:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s - %(levelname)s - %(funcName)s - %(lineno)d - %(message)s')
+    try:
+        import uvloop
+        uvloop.install()
+    except ModuleNotFoundError:
+        pass
     asyncio.run(main('--debug' in sys.argv))
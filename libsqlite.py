@@ -19,13 +19,23 @@ import logging
 import os
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
-from typing import Generator, Optional, Tuple
+from typing import Any, List, Optional, Tuple
 
 import aiosqlite
 
 logger = logging.getLogger("code_poster").getChild("sqlite")
 logger.setLevel(logging.getLogger("code_poster").level)
 
+_WRITE_BATCH_SIZE = 64
+
+_PRAGMA_STATEMENT = '''
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -20000;
+    PRAGMA mmap_size = 268435456;
+'''
+
 _DROP_STATEMENT_PasscodeTracker = '''
     DROP TABLE IF EXISTS "code";
     DROP TABLE IF EXISTS "users";
@@ -50,8 +60,28 @@ _CREATE_STATEMENT_PasscodeTracker = '''
         "str"   TEXT NOT NULL,
         "send_by" INTEGER NOT NULL
     );
+
+    CREATE INDEX "history_str_idx" ON "history"("str" COLLATE NOCASE);
 '''
 
+_MIGRATE_STATEMENT_PasscodeTracker = '''
+    CREATE INDEX IF NOT EXISTS "history_str_idx" ON "history"("str" COLLATE NOCASE);
+'''
+
+
+# Statements used by PasscodeTracker, kept together so each query is written in one place.
+_SQL_QUERY_CODE = '''SELECT * FROM "code" WHERE "str" = ?'''
+_SQL_QUERY_ALL_CODE = '''SELECT "str" FROM "code"'''
+_SQL_UPDATE_CODE = '''UPDATE "code" SET "fr" = ? WHERE "str" = ?'''
+_SQL_INSERT_CODE = '''INSERT INTO "code" VALUES (?, ?, 0)'''
+_SQL_INSERT_CODE_OR_IGNORE = '''INSERT OR IGNORE INTO "code" VALUES (?, ?, 0)'''
+_SQL_INSERT_HISTORY = '''INSERT INTO "history" VALUES (?, ?)'''
+_SQL_QUERY_HISTORY = '''SELECT "send_by" FROM "history" WHERE "str" LIKE ?'''
+_SQL_QUERY_USER = '''SELECT * FROM "users" WHERE "id" = ?'''
+_SQL_QUERY_ALL_USER = '''SELECT * FROM "users" WHERE "authorized" = 1'''
+_SQL_INSERT_USER = '''INSERT INTO "users" VALUES (?, 1)'''
+_SQL_DELETE_USER = '''DELETE FROM "users" WHERE "id" = ?'''
+
 
 @dataclass(init=False)
 class CodeStatus:
@@ -67,10 +97,122 @@ class SqliteBase(metaclass=ABCMeta):
     def __init__(self, file_name: str):
         self.file_name = file_name
         self.lock = asyncio.Lock()
+        self._db: Optional[aiosqlite.Connection] = None
+        self._write_queue: asyncio.Queue = asyncio.Queue()
+        self._writer_task: Optional[asyncio.Task] = None
+        self._closed = False
+        # Held by the writer while a batch transaction is open, reads wait on it so they never
+        # see rows from a savepoint that is about to be rolled back
+        self._batch_lock = asyncio.Lock()
+
+    async def _ensure_conn(self) -> aiosqlite.Connection:
+        async with self.lock:
+            if self._closed:
+                raise RuntimeError('Database is closed')
+            if self._db is None:
+                self._db = await aiosqlite.connect(self.file_name)
+                async with self._db.executescript(_PRAGMA_STATEMENT):
+                    pass
+                async with self._db.execute('SELECT * FROM pragma_journal_mode') as cursor:
+                    logger.debug('Database journal mode: %s', (await cursor.fetchone())[0])
+            return self._db
+
+    async def start(self) -> None:
+        await self._ensure_conn()
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._writer_task is not None:
+            if not self._writer_task.done():
+                await self._write_queue.join()
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        async with self.lock:
+            if self._db is not None:
+                await self._db.close()
+                self._db = None
+
+    # Statements passed in one call are applied together or not at all,
+    # a list of parameters is run with executemany, anything else with execute
+    async def _write(self, *statements: Tuple[str, Any]) -> None:
+        if self._closed:
+            raise RuntimeError('Database is closed')
+        if self._writer_task is None:
+            await self.start()
+        elif self._writer_task.done():
+            raise RuntimeError('Database writer is not running')
+        future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((statements, future))
+        await future
+
+    async def _writer_loop(self) -> None:
+        db = await self._ensure_conn()
+        while True:
+            items = [await self._write_queue.get()]
+            while len(items) < _WRITE_BATCH_SIZE:
+                try:
+                    items.append(self._write_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                async with self._batch_lock:
+                    await self._write_batch(db, items)
+            finally:
+                for _ in items:
+                    self._write_queue.task_done()
+
+    @staticmethod
+    async def _write_batch(db: aiosqlite.Connection,
+                           items: List[Tuple[Tuple[Tuple[str, Any], ...], asyncio.Future]]) -> None:
+        # Every queued write gets its own savepoint so a failing one does not discard the rest of the batch
+        succeeded = []
+        try:
+            async with db.execute('BEGIN'):
+                pass
+            for statements, future in items:
+                async with db.execute('SAVEPOINT "write_item"'):
+                    pass
+                try:
+                    for sql, params in statements:
+                        if isinstance(params, list):
+                            async with db.executemany(sql, params):
+                                pass
+                        else:
+                            async with db.execute(sql, params):
+                                pass
+                except Exception as e:
+                    async with db.execute('ROLLBACK TO "write_item"'):
+                        pass
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    succeeded.append(future)
+                async with db.execute('RELEASE "write_item"'):
+                    pass
+            await db.commit()
+        except Exception as e:
+            logger.exception('Commit write batch failed')
+            try:
+                await db.rollback()
+            except Exception:
+                pass
+            for _statements, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in succeeded:
+            if not future.done():
+                future.set_result(None)
 
     @classmethod
     async def _new(cls, file_name: str, drop_statement: str, create_statement: str, *,
-                   main_table_name: str, renew: bool = False) -> 'SqliteBase':
+                   main_table_name: str, migrate_statement: str = '', renew: bool = False) -> 'SqliteBase':
         if renew:
             try:
                 os.remove(file_name)
@@ -79,9 +221,13 @@ class SqliteBase(metaclass=ABCMeta):
         async with aiosqlite.connect(file_name) as db:
             async with db.execute('''SELECT name FROM sqlite_master WHERE type = 'table' AND name = ? ''',
                                   (main_table_name,)) as cursor:
-                if (await cursor.fetchone()) is not None:
-                    logger.debug('Found database, load it')
-                    return cls(file_name)
+                exists = (await cursor.fetchone()) is not None
+            if exists:
+                logger.debug('Found database, load it')
+                if migrate_statement:
+                    async with db.executescript(migrate_statement):
+                        pass
+                return cls(file_name)
             logger.debug('Create new database structure')
             async with db.executescript(drop_statement):
                 pass
@@ -100,65 +246,63 @@ class PasscodeTracker(SqliteBase):
     @classmethod
     async def new(cls, file_name: str, *, renew: bool = False) -> 'PasscodeTracker':
         return await cls._new(file_name, _DROP_STATEMENT_PasscodeTracker, _CREATE_STATEMENT_PasscodeTracker,
-                              main_table_name="code", renew=renew)
+                              main_table_name="code", migrate_statement=_MIGRATE_STATEMENT_PasscodeTracker,
+                              renew=renew)
 
     async def query(self, code: str) -> Optional[CodeStatus]:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''SELECT * FROM "code" WHERE "str" = ?''', (code.lower(),)) as cursor:
-                r = await cursor.fetchone()
-                if r is None:
-                    return None
-                return CodeStatus(r[1], r[2])
+        db = await self._ensure_conn()
+        async with self._batch_lock, db.execute(_SQL_QUERY_CODE, (code.lower(),)) as cursor:
+            r = await cursor.fetchone()
+            if r is None:
+                return None
+            return CodeStatus(r[1], r[2])
+
+    async def query_all_code(self) -> List[str]:
+        db = await self._ensure_conn()
+        async with self._batch_lock, db.execute(_SQL_QUERY_ALL_CODE) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
 
     async def update(self, code: str, fr: bool) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''UPDATE "code" SET "fr" = ? WHERE "str" = ?''', (int(fr), code.lower())):
-                pass
-            await db.commit()
+        await self._write((_SQL_UPDATE_CODE, (int(fr), code.lower())))
 
     async def insert(self, code: str, message_id: int) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''INSERT INTO "code" VALUES (?, ?, 0)''', (code.lower(), message_id)):
-                pass
-            await db.commit()
+        await self._write((_SQL_INSERT_CODE, (code.lower(), message_id)))
 
     async def insert_history(self, s: str, sender: int) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''INSERT INTO "history" VALUES (?, ?)''', (s.lower(), sender)):
-                pass
-            await db.commit()
+        await self._write((_SQL_INSERT_HISTORY, (s.lower(), sender)))
+
+    async def insert_pair(self, code: str, message_id: int, sender: int) -> None:
+        await self._write((_SQL_INSERT_CODE, (code.lower(), message_id)),
+                          (_SQL_INSERT_HISTORY, (code.lower(), sender)))
+
+    async def insert_many(self, rows: List[Tuple[str, int]], sender: int) -> None:
+        rows = [(code.lower(), message_id) for code, message_id in rows]
+        await self._write((_SQL_INSERT_CODE_OR_IGNORE, rows),
+                          (_SQL_INSERT_HISTORY, [(code, sender) for code, _ in rows]))
 
     async def query_history(self, s: str) -> Optional[Tuple[str, int]]:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''SELECT "send_by" FROM "history" WHERE "str" LIKE ?''',
-                                  (f'{s.lower()}%',)) as cursor:
-                r = await cursor.fetchone()
-                if r is None:
-                    return None
-                return r
+        db = await self._ensure_conn()
+        async with self._batch_lock, db.execute(_SQL_QUERY_HISTORY, (f'{s.lower()}%',)) as cursor:
+            r = await cursor.fetchone()
+            if r is None:
+                return None
+            return r
 
     async def query_user(self, user_id: int) -> Optional[bool]:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''SELECT * FROM "users" WHERE "id" = ?''', (user_id,)) as cursor:
-                r = await cursor.fetchone()
-                if r is None:
-                    return None
-                return bool(r[1])
-
-    async def query_all_user(self) -> Generator[int, None, None]:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''SELECT * FROM "users" WHERE "authorized" = 1''') as cursor:
-                for user_row in await cursor.fetchall():
-                    yield user_row[0]
+        db = await self._ensure_conn()
+        async with self._batch_lock, db.execute(_SQL_QUERY_USER, (user_id,)) as cursor:
+            r = await cursor.fetchone()
+            if r is None:
+                return None
+            return bool(r[1])
+
+    async def query_all_user(self) -> List[int]:
+        db = await self._ensure_conn()
+        async with self._batch_lock, db.execute(_SQL_QUERY_ALL_USER) as cursor:
+            return [user_row[0] for user_row in await cursor.fetchall()]
 
     async def insert_user(self, user_id: int) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''INSERT INTO "users" VALUES (?, 1)''', (user_id,)):
-                pass
-            await db.commit()
+        await self._write((_SQL_INSERT_USER, (user_id,)))
 
     async def delete_user(self, user_id: int) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''DELETE FROM "users" WHERE "id" = ?''', (user_id,)):
-                pass
-            await db.commit()
+        await self._write((_SQL_DELETE_USER, (user_id,)))